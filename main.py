@@ -1,6 +1,7 @@
 import aiohttp
 import asyncio
 import argparse
+import orjson
 
 from mapillary_client.api import CoverageAPI, EntitiesAPI
 from mapillary_client.download import Downloader
@@ -23,6 +24,9 @@ class Config:
     north: float
     zoom: int = 10
     thumb: str = "thumb_original_url"
+    max_inflight: int = 64
+    savers: int = 64
+    layer: str = "sequence"
 
 
 def _get_config_file():
@@ -42,13 +46,44 @@ def main() -> None:
     with open(config_file, "r") as toml_file:
         config_dict = toml.load(toml_file)
     config = Config(**config_dict)
-    asyncio.run(amain(config))
+    with asyncio.Runner(loop_factory=_get_loop_factory()) as runner:
+        runner.run(amain(config))
+
+
+def _get_loop_factory():
+    try:
+        import uvloop
+    except ImportError:
+        logging.getLogger().info("uvloop is not installed, using the asyncio loop")
+        return None
+    return uvloop.new_event_loop
+
+
+def _json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+
+def _make_session(config: Config) -> aiohttp.ClientSession:
+    # The default pool caps at 100 connections; the semaphore is the real limit
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=config.max_inflight,
+        ttl_dns_cache=600,
+        enable_cleanup_closed=True,
+        keepalive_timeout=75,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60),
+        json_serialize=_json_dumps,
+    )
 
 
 async def amain(config: Config):
-    async with aiohttp.ClientSession() as session:
-        coverage_api = CoverageAPI(session=session)
-        entities_api = EntitiesAPI(session=session)
+    async with _make_session(config) as session:
+        semaphore = asyncio.Semaphore(config.max_inflight)
+        coverage_api = CoverageAPI(session=session, semaphore=semaphore)
+        entities_api = EntitiesAPI(session=session, semaphore=semaphore)
         downloader = Downloader(
             config.download_directory,
             session=session,
@@ -56,10 +91,16 @@ async def amain(config: Config):
             coverage_api=coverage_api,
             thumb=config.thumb,
             zoom=config.zoom,
+            semaphore=semaphore,
+            savers=config.savers,
+            layer=config.layer,
         )
-        await downloader.download_region(
-            config.west, config.south, config.east, config.north
-        )
+        try:
+            await downloader.download_region(
+                config.west, config.south, config.east, config.north
+            )
+        finally:
+            coverage_api.close()
 
 
 if __name__ == "__main__":
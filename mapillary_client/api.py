@@ -1,19 +1,38 @@
-from typing import NamedTuple, List, Dict, Any, Union, TypeVar
-from string import Template
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import aclosing
+import functools
+from typing import (
+    NamedTuple,
+    List,
+    Dict,
+    Any,
+    Union,
+    TypeVar,
+    Set,
+    AsyncIterator,
+)
+from urllib.parse import quote
 
 from tqdm.auto import tqdm
 import aiohttp
 import asyncio
+import multiprocessing
+import os
 import mercantile
+import more_itertools as mit
+import orjson
 
 from .keeper import secret_keeper
-from .utils import init_if_none
+from .utils import init_if_none, add_if_missing, get_with_retry
 import logging
 from vt2geojson.tools import vt_bytes_to_geojson
 
 
 LOGGER = logging.getLogger()
 
+DEFAULT_MAX_INFLIGHT = 64
+DEFAULT_BATCH_SIZE = 50
+
 
 class ImageFields:
     def __init__(self):
@@ -44,6 +63,12 @@ class ImageFields:
 
 
 IMAGE_FIELDS = ImageFields()
+_IMAGE_FIELDS_QUERY = "fields=" + ",".join(vars(IMAGE_FIELDS).values())
+
+
+@functools.lru_cache(maxsize=None)
+def _fields_query(fields):
+    return "fields=" + ",".join(fields)
 
 
 MAPILLARY_CLIENT_SECRET = "MAPILLARY_CLIENT_SECRET"
@@ -69,6 +94,10 @@ class TileType:
     OVERVIEW_LAYER = "overview"
 
 
+# Mapillary only serves the image layer of the coverage tiles at this zoom
+IMAGE_LAYER_ZOOM = 14
+
+
 Id = Union[str, int]
 ImageMetadata = Dict[str, Any]
 
@@ -76,20 +105,23 @@ ImageMetadata = Dict[str, Any]
 class EntitiesAPI:
     """docstring for ImageAPI"""
 
-    IMAGE_URL = Template("https://graph.mapillary.com/$image_id")
-    SEQUENCE_URL = Template(
-        "https://graph.mapillary.com/image_ids?sequence_id=$sequence_id"
-    )
-    ENTITIES_URL = Template("https://graph.mapillary.com?ids=$ids")
+    GRAPH_URL = "https://graph.mapillary.com"
+    SEQUENCE_URL = f"{GRAPH_URL}/image_ids?sequence_id="
+    ENTITIES_URL = f"{GRAPH_URL}/?ids="
 
     def __init__(
         self,
         session: aiohttp.ClientSession = None,
         verbose: bool = True,
         access_token: str = None,
+        semaphore: asyncio.Semaphore = None,
     ) -> None:
         self.session = session
         self.verbose = verbose
+        self.semaphore = init_if_none(
+            semaphore, asyncio.Semaphore(DEFAULT_MAX_INFLIGHT)
+        )
+        # Without a token the default is looked up on first use, then cached
         self.headers = None
         if access_token is not None:
             self.headers = self._add_token_to_header(access_token)
@@ -105,11 +137,16 @@ class EntitiesAPI:
         session = init_if_none(session, self.session)
         if not isinstance(ids, list):
             ids = [ids]
-        url = self.ENTITIES_URL.substitute(ids=",".join(ids))
-        async with session.get(
-            url, headers=self._make_header(access_token)
+        ids = quote(",".join(map(str, ids)), safe=",")
+        url = f"{self.ENTITIES_URL}{ids}"
+        url = self._collect_fields(url, fields)
+        async with get_with_retry(
+            session,
+            url,
+            semaphore=self.semaphore,
+            headers=self._make_header(access_token),
         ) as response:
-            response = await response.json()
+            response = orjson.loads(await response.read())
         return response
 
     async def aget_image(
@@ -122,27 +159,18 @@ class EntitiesAPI:
         thumbs: List[str] = None,
     ) -> Union[ImageMetadata, NamedPair]:
         session = init_if_none(session, self.session)
-        url = self.IMAGE_URL.substitute(image_id=image_id)
+        url = f"{self.GRAPH_URL}/{quote(str(image_id), safe='')}"
         url = self._collect_fields(url, fields)
 
-        async with session.get(
-            url, headers=self._make_header(access_token)
+        async with get_with_retry(
+            session,
+            url,
+            semaphore=self.semaphore,
+            headers=self._make_header(access_token),
         ) as response:
-            image = await response.json()
-
-        if thumbs is not None:
-            if isinstance(thumbs, list):
-                thumbs_map = {}
-                for thumb in thumbs:
-                    async with session.get(image[thumb]) as response:
-                        thumbs_map[f"{thumb}_image"] = await response.read()
-                image = NamedPair(image, thumbs_map)
-            elif isinstance(thumbs, str):
-                async with session.get(image[thumbs]) as response:
-                    image_data = await response.read()
-                image = NamedPair(image, image_data)
+            image = orjson.loads(await response.read())
 
-        return image
+        return self._attach_thumbs(image, thumbs)
 
     async def aget_sequence_data(
         self,
@@ -152,28 +180,86 @@ class EntitiesAPI:
         verbose: bool = True,
         **kwargs,
     ) -> NamedPair:
+        sequence_data = self.agenerate_sequence_data(
+            sequence_id, session, access_token, verbose, **kwargs
+        )
+        async with aclosing(sequence_data):
+            images = [image async for image in sequence_data]
+        return sequence_id, images
+
+    async def agenerate_sequence_data(
+        self,
+        sequence_id,
+        session: aiohttp.ClientSession = None,
+        access_token: str = None,
+        verbose: bool = True,
+        **kwargs,
+    ) -> AsyncIterator[Union[ImageMetadata, NamedPair]]:
         sequence = await self.aget_sequence(sequence_id, session, access_token)
+        images = self.agenerate_images(
+            [image["id"] for image in sequence["data"]],
+            session,
+            access_token,
+            verbose,
+            description=f"sequence {sequence_id}",
+            **kwargs,
+        )
+        async with aclosing(images):
+            async for image in images:
+                yield image
+
+    async def agenerate_images(
+        self,
+        image_ids: List[Id],
+        session: aiohttp.ClientSession = None,
+        access_token: str = None,
+        verbose: bool = True,
+        *,
+        fields: List[str] = None,
+        thumbs: List[str] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        image_registry: Set[Id] = None,
+        description: str = None,
+    ) -> AsyncIterator[Union[ImageMetadata, NamedPair]]:
+        if image_registry is not None:
+            # No await between check and add, so overlapping sequences cannot race
+            image_ids = [
+                image_id
+                for image_id in image_ids
+                if add_if_missing(image_registry, image_id)
+            ]
+        # Metadata is fetched in batches through the multi-id endpoint
         ts = [
-            self.aget_image(
-                image["id"], session=session, access_token=access_token, **kwargs
+            asyncio.create_task(
+                self.aget_by_id(
+                    ids_chunk,
+                    session=session,
+                    fields=fields,
+                    access_token=access_token,
+                )
             )
-            for image in sequence["data"]
+            for ids_chunk in mit.chunked(image_ids, batch_size)
         ]
 
-        tasks = asyncio.as_completed(ts)
-        total = len(ts)
-        images = []
-        for num, task in enumerate(tasks, 1):
-            images.append(await task)
-            if verbose:
-                LOGGER.info(
-                    "Download [%03d/%03d] images for sequence %s",
-                    num,
-                    total,
-                    sequence_id,
-                )
-
-        return sequence_id, images
+        total = len(image_ids)
+        num = 0
+        try:
+            for task in asyncio.as_completed(ts):
+                images_batch = await task
+                for image in images_batch.values():
+                    yield self._attach_thumbs(image, thumbs)
+                num += len(images_batch)
+                if verbose:
+                    LOGGER.info(
+                        "Download [%03d/%03d] images for %s",
+                        num,
+                        total,
+                        description,
+                    )
+        finally:
+            # A consumer that stops early must not leave batches running
+            for task in ts:
+                task.cancel()
 
     async def aget_sequence(
         self,
@@ -181,22 +267,36 @@ class EntitiesAPI:
         session: aiohttp.ClientSession = None,
         access_token: str = None,
     ) -> Dict[str, List[Dict[str, str]]]:
-        url = self.SEQUENCE_URL.substitute(sequence_id=sequence_id)
+        url = f"{self.SEQUENCE_URL}{quote(str(sequence_id), safe='')}"
         session = init_if_none(session, self.session)
-        async with session.get(
-            url, headers=self._make_header(access_token)
+        async with get_with_retry(
+            session,
+            url,
+            semaphore=self.semaphore,
+            headers=self._make_header(access_token),
         ) as response:
-            response = await response.json()
+            response = orjson.loads(await response.read())
         return response
 
     def _make_header(self, access_token):
-        if access_token is None:
-            if self.headers is None:
-                return self._add_token_to_header(secret_keeper[MAPILLARY_CLIENT_SECRET])
-            else:
-                return self.headers
-        else:
+        if access_token is not None:
             return self._add_token_to_header(access_token)
+        if self.headers is None:
+            self.headers = self._add_token_to_header(
+                secret_keeper[MAPILLARY_CLIENT_SECRET]
+            )
+        return self.headers
+
+    @staticmethod
+    def _attach_thumbs(
+        image: ImageMetadata, thumbs: Union[str, List[str]] = None
+    ) -> Union[ImageMetadata, NamedPair]:
+        # Only the thumb urls are attached; the bytes are streamed by the caller
+        if isinstance(thumbs, list):
+            return NamedPair(image, {thumb: image[thumb] for thumb in thumbs})
+        elif isinstance(thumbs, str):
+            return NamedPair(image, image[thumbs])
+        return image
 
     @staticmethod
     def _add_token_to_header(access_token):
@@ -204,31 +304,64 @@ class EntitiesAPI:
 
     @staticmethod
     def _collect_fields(url, fields):
-        if fields is not None:
-            if fields == "image":
-                fields = list(vars(IMAGE_FIELDS).values())
-            elif not isinstance(fields, list) or not isinstance(fields[0], str):
-                raise ValueError(
-                    "`fields` should be a list of strings, `None`, or `image`"
-                )
-            fields = ",".join(fields)
-            url = f"{url}?fields={fields}"
-        return url
+        if fields is None:
+            return url
+        if fields == "image":
+            query = _IMAGE_FIELDS_QUERY
+        elif not isinstance(fields, list) or not isinstance(fields[0], str):
+            raise ValueError(
+                "`fields` should be a list of strings, `None`, or `image`"
+            )
+        else:
+            query = _fields_query(tuple(fields))
+        separator = "&" if "?" in url else "?"
+        return f"{url}{separator}{query}"
 
 
 class CoverageAPI:
     """docstring for Coverage"""
 
-    VTILES_URL = Template(
-        "https://tiles.mapillary.com/maps/vtp/$vtile_type/2/{z}/{x}/{y}?access_token={access_token}"
-    )
-    COVERAGE_VTILES_URL = VTILES_URL.safe_substitute(vtile_type="mly1_public")
+    VTILES_URL = "https://tiles.mapillary.com/maps/vtp"
+    COVERAGE_VTILES_URL = f"{VTILES_URL}/mly1_public/2"
 
     def __init__(
-        self, session: aiohttp.ClientSession = None, verbose: bool = True
+        self,
+        session: aiohttp.ClientSession = None,
+        verbose: bool = True,
+        semaphore: asyncio.Semaphore = None,
+        decode_pool: Executor = None,
+        access_token: str = None,
     ) -> None:
         self.session = session
         self.verbose = verbose
+        self.semaphore = init_if_none(
+            semaphore, asyncio.Semaphore(DEFAULT_MAX_INFLIGHT)
+        )
+        # Without a token the default is looked up on first use, then cached
+        self._tile_query = None
+        if access_token is not None:
+            self._tile_query = self._make_tile_query(access_token)
+        # Vector tile decoding is CPU bound and would otherwise stall the loop
+        # An owned pool is only started on the first decode and shut down by `close`
+        self._decode_pool = decode_pool
+        self._owns_decode_pool = decode_pool is None
+
+    def close(self) -> None:
+        if self._owns_decode_pool and self._decode_pool is not None:
+            # Called from the event loop, so don't wait for the workers to exit
+            self._decode_pool.shutdown(wait=False, cancel_futures=True)
+            self._decode_pool = None
+
+    def _get_decode_pool(self) -> Executor:
+        if self._decode_pool is None:
+            # Forking a loop that already runs executor threads is unsafe
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            self._decode_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context(method),
+            )
+        return self._decode_pool
 
     async def aget_tile(
         self,
@@ -238,16 +371,24 @@ class CoverageAPI:
         astuple: bool = True,
         layer=None,
     ):
-        access_token = init_if_none(
-            access_token, secret_keeper[MAPILLARY_CLIENT_SECRET]
-        )
+        if access_token is not None:
+            tile_query = self._make_tile_query(access_token)
+        else:
+            if self._tile_query is None:
+                self._tile_query = self._make_tile_query(
+                    secret_keeper[MAPILLARY_CLIENT_SECRET]
+                )
+            tile_query = self._tile_query
         session = init_if_none(session, self.session)
-        tile_url = self.COVERAGE_VTILES_URL.format(
-            x=tile.x, y=tile.y, z=tile.z, access_token=access_token
-        )
-        async with session.get(tile_url) as response:
+        tile_url = f"{self.COVERAGE_VTILES_URL}/{tile.z}/{tile.x}/{tile.y}{tile_query}"
+        async with get_with_retry(
+            session, tile_url, semaphore=self.semaphore
+        ) as response:
             content = await response.read()
-        content = vt_bytes_to_geojson(
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(
+            self._get_decode_pool(),
+            vt_bytes_to_geojson,
             content,
             tile.x,
             tile.y,
@@ -258,6 +399,10 @@ class CoverageAPI:
             return TilePair(tile, content)
         return content
 
+    @staticmethod
+    def _make_tile_query(access_token):
+        return f"?access_token={access_token}"
+
     async def agenerate_tiles(self, tiles: List[mercantile.Tile], **kwargs):
         ts = [self.aget_tile(tile, **kwargs) for tile in tiles]
         tasks = asyncio.as_completed(ts)
@@ -1,21 +1,57 @@
 import asyncio
+import contextlib
+from collections import defaultdict
 import more_itertools as mit
-import json
+import orjson
 import os
-from typing import List, Union
+from typing import Iterator, List, Union
 import mercantile
 import aiohttp
-import aiofiles
 from pathlib import Path
 
-from .api import EntitiesAPI, CoverageAPI, TileType, NamedPair, ImageMetadata
-from .utils import init_if_none
+from .api import (
+    EntitiesAPI,
+    CoverageAPI,
+    TileType,
+    NamedPair,
+    ImageMetadata,
+    DEFAULT_MAX_INFLIGHT,
+    IMAGE_LAYER_ZOOM,
+)
+from .utils import (
+    init_if_none,
+    add_if_missing,
+    get_with_retry,
+)
 
 import logging
 
 LOGGER = logging.getLogger()
 
 
+class MetadataColumns:
+    """Image metadata stored as one list per field instead of one dict per image"""
+
+    def __init__(self):
+        self.columns = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, metadata: ImageMetadata) -> None:
+        for key, value in metadata.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = [None] * self.size
+            column.append(value)
+        self.size += 1
+        # Fields missing from this image keep the columns aligned
+        for column in self.columns.values():
+            if len(column) < self.size:
+                column.append(None)
+
+
 class Downloader:
     def __init__(
         self,
@@ -29,21 +65,55 @@ class Downloader:
         fields: str = "image",
         zoom: int = 14,
         chunks: int = 5,
+        max_inflight: int = DEFAULT_MAX_INFLIGHT,
+        semaphore: asyncio.Semaphore = None,
+        savers: int = None,
+        queue_size: int = 32,
+        tile_workers: int = 16,
+        layer: str = TileType.SEQUENCE_LAYER,
     ):
+        if layer not in (TileType.SEQUENCE_LAYER, TileType.IMAGE_LAYER):
+            raise ValueError(
+                f"`layer` should be `{TileType.SEQUENCE_LAYER}` "
+                f"or `{TileType.IMAGE_LAYER}`, got `{layer}`"
+            )
+        _check_layer_zoom(layer, zoom)
+        # One semaphore bounds every outbound request of the pipeline. APIs passed
+        # in by the caller keep their own, so pass the same `semaphore` to them.
+        self._sem = init_if_none(semaphore, asyncio.Semaphore(max_inflight))
+        self._owns_coverage_api = coverage_api is None
         if coverage_api is None:
-            coverage_api = CoverageAPI(session, verbose=verbose)
+            coverage_api = CoverageAPI(session, verbose=verbose, semaphore=self._sem)
         if entities_api is None:
-            entities_api = EntitiesAPI(session, verbose=verbose)
+            entities_api = EntitiesAPI(session, verbose=verbose, semaphore=self._sem)
         self.session = session
         self.entities_api = entities_api
         self.coverage_api = coverage_api
         self.directory = directory
-        self._registry_lock = asyncio.Lock()
         self._sequence_registry = set()
+        self._image_registry = set()
+        self._sequence_directories = set()
         self._fields = fields
         self._thumb = thumb
         self._zoom = zoom
         self._chunks = chunks
+        # Savers are the only thumb downloaders, so by default they can fill every
+        # slot of the semaphore
+        self._savers = init_if_none(savers, max_inflight)
+        self._queue_size = queue_size
+        self._layer = layer
+        self._tile_workers = tile_workers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        # Only the CoverageAPI built here is ours to shut down
+        if self._owns_coverage_api:
+            self.coverage_api.close()
 
     async def download_region(
         self,
@@ -62,62 +132,226 @@ class Downloader:
         session = init_if_none(session, self.session)
         directory = init_if_none(directory, self.directory)
         zoom = init_if_none(zoom, self._zoom)
+        _check_layer_zoom(self._layer, zoom)
         LOGGER.info(
             f"Start downloading region: west={west}, south={south}, east={east}, north={north}"
         )
-        for tile in mercantile.tiles(west, south, east, north, zoom):
-            await self._get_entities(tile, session=session)
+        tiles = mercantile.tiles(west, south, east, north, zoom)
+        # Images flow through a bounded queue so memory stays flat per sequence
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        async with asyncio.TaskGroup() as saver_group:
+            savers = [
+                saver_group.create_task(self._save_images(queue, session))
+                for _ in range(self._savers)
+            ]
+            # Tiles are independent; the workers pull them lazily from one iterator
+            # and the shared semaphore bounds the actual requests
+            async with asyncio.TaskGroup() as tile_group:
+                # Spare workers find the iterator exhausted and return at once
+                for _ in range(self._tile_workers):
+                    tile_group.create_task(self._get_tiles(tiles, queue, session))
+            for _ in savers:
+                await queue.put(None)
 
-    async def _save_sequence(
+    async def _get_tiles(
         self,
-        sequence_id: str,
-        image_datas: List[Union[ImageMetadata, NamedPair]],
+        tiles: Iterator[mercantile.Tile],
+        queue: asyncio.Queue,
+        session: aiohttp.ClientSession,
+    ) -> None:
+        for tile in tiles:
+            await self._get_entities(tile, queue, session=session)
+
+    async def _save_images(
+        self, queue: asyncio.Queue, session: aiohttp.ClientSession = None
     ) -> None:
-        LOGGER.info("Save sequence %s", sequence_id)
-        sequence_paht = Path(self.directory) / sequence_id
-        os.makedirs(sequence_paht, exist_ok=True)
-        for image_data in image_datas:
-            image_path = sequence_paht / image_data.metadata["id"]
-            async with aiofiles.open(image_path, "wb") as asyncfile:
-                await asyncfile.write(image_data.data)
+        while (item := await queue.get()) is not None:
+            image_path, thumbs = item
+            if isinstance(thumbs, dict):
+                for thumb, url in thumbs.items():
+                    await self._save_thumb(url, f"{image_path}_{thumb}", session)
+            else:
+                await self._save_thumb(thumbs, image_path, session)
 
-            async with aiofiles.open(f"{image_path}.json", "w") as json_file:
-                await json_file.write(json.dumps(image_data.metadata))
+    async def _save_thumb(
+        self,
+        url: str,
+        path: Union[str, Path],
+        session: aiohttp.ClientSession = None,
+    ) -> None:
+        # A failed image is logged and skipped instead of cancelling the region
+        try:
+            await self._stream_to_file(url, path, session)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+            LOGGER.error("Failed to download %s from %s: %s", path, url, error)
+
+    async def _stream_to_file(
+        self,
+        url: str,
+        path: Union[str, Path],
+        session: aiohttp.ClientSession = None,
+        chunk_size: int = 1 << 16,
+        buffer_size: int = 1 << 20,
+    ) -> None:
+        session = init_if_none(session, self.session)
+        loop = asyncio.get_running_loop()
+        # Chunks are buffered so most thumbs take a single executor hop to disk,
+        # and only a complete download is moved into place
+        part_path = f"{path}.part"
+        buffer = bytearray()
+        mode = "wb"
+        try:
+            async with get_with_retry(session, url, semaphore=self._sem) as response:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    buffer += chunk
+                    if len(buffer) >= buffer_size:
+                        await loop.run_in_executor(
+                            None, _write_file, part_path, buffer, mode
+                        )
+                        buffer = bytearray()
+                        mode = "ab"
+            await loop.run_in_executor(None, _write_file, part_path, buffer, mode)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, path)
 
     async def _get_entities(
-        self, tile: mercantile.Tile, session: aiohttp.ClientSession
+        self,
+        tile: mercantile.Tile,
+        queue: asyncio.Queue,
+        session: aiohttp.ClientSession,
     ):
         session = init_if_none(session, self.session)
+        if self._layer == TileType.IMAGE_LAYER:
+            await self._get_tile_images(tile, queue, session)
+            return
+
         sequences_vtile = await self.coverage_api.aget_tile(
             tile, session, layer=TileType.SEQUENCE_LAYER, astuple=False
         )
 
-        async with self._registry_lock:
-            # The sequences need to be downloaded only once
-            new_sequence_ids = self._update_registry(sequences_vtile)
+        # The sequences need to be downloaded only once. `_update_registry` never
+        # awaits, so no other task can observe the registry half-updated.
+        new_sequence_ids = self._update_registry(sequences_vtile)
 
         LOGGER.info(f"Download tile {tile} with {len(new_sequence_ids)} sequences")
         for sequences_chunk in mit.chunked(new_sequence_ids, self._chunks):
-            tasks = [
-                self.entities_api.aget_sequence_data(
-                    sequence_id,
-                    session=session,
-                    fields=self._fields,
-                    thumbs=self._thumb,
-                )
-                for sequence_id in sequences_chunk
-            ]
+            async with asyncio.TaskGroup() as sequence_group:
+                for sequence_id in sequences_chunk:
+                    sequence_group.create_task(
+                        self._get_sequence(sequence_id, queue, session)
+                    )
 
-            for task in asyncio.as_completed(tasks):
-                sequence_id, images_data = await task
-                await self._save_sequence(sequence_id, images_data)
+    async def _get_sequence(
+        self,
+        sequence_id: str,
+        queue: asyncio.Queue,
+        session: aiohttp.ClientSession,
+    ) -> None:
+        sequence_metadata = MetadataColumns()
+        images = self.entities_api.agenerate_sequence_data(
+            sequence_id,
+            session=session,
+            fields=self._fields,
+            thumbs=self._thumb,
+            image_registry=self._image_registry,
+        )
+        async with contextlib.aclosing(images):
+            async for image_data in images:
+                metadata = await self._queue_image(sequence_id, image_data, queue)
+                sequence_metadata.append(metadata)
+
+        if sequence_metadata:
+            await self._save_metadata(
+                Path(self.directory) / sequence_id / "sequence.json",
+                sequence_metadata,
+            )
+            LOGGER.info("Saved metadata for sequence %s", sequence_id)
+
+    async def _get_tile_images(
+        self,
+        tile: mercantile.Tile,
+        queue: asyncio.Queue,
+        session: aiohttp.ClientSession,
+    ) -> None:
+        # The image layer already lists ids, so the per-sequence lookup is skipped
+        images_vtile = await self.coverage_api.aget_tile(
+            tile, session, layer=TileType.IMAGE_LAYER, astuple=False
+        )
+        image_sequences = {
+            str(image["properties"]["id"]): image["properties"]["sequence_id"]
+            for image in images_vtile["features"]
+        }
+        LOGGER.info(f"Download tile {tile} with {len(image_sequences)} images")
+
+        tile_metadata = defaultdict(MetadataColumns)
+        images = self.entities_api.agenerate_images(
+            list(image_sequences),
+            session=session,
+            fields=self._fields,
+            thumbs=self._thumb,
+            image_registry=self._image_registry,
+            description=f"tile {tile}",
+        )
+        async with contextlib.aclosing(images):
+            async for image_data in images:
+                image_id = _get_metadata(image_data)["id"]
+                sequence_id = image_sequences[image_id]
+                metadata = await self._queue_image(sequence_id, image_data, queue)
+                tile_metadata[sequence_id].append(metadata)
+
+        # A sequence can span several tiles, so each tile writes its own file
+        for sequence_id, sequence_metadata in tile_metadata.items():
+            await self._save_metadata(
+                Path(self.directory) / sequence_id / f"{tile.z}_{tile.x}_{tile.y}.json",
+                sequence_metadata,
+            )
+
+    async def _queue_image(
+        self,
+        sequence_id: str,
+        image_data: Union[ImageMetadata, NamedPair],
+        queue: asyncio.Queue,
+    ) -> ImageMetadata:
+        sequence_path = Path(self.directory) / sequence_id
+        if add_if_missing(self._sequence_directories, sequence_id):
+            os.makedirs(sequence_path, exist_ok=True)
+        if not isinstance(image_data, NamedPair):
+            return image_data
+        await queue.put((sequence_path / image_data.metadata["id"], image_data.data))
+        return image_data.metadata
+
+    async def _save_metadata(self, path: Path, metadata: MetadataColumns) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, path.write_bytes, orjson.dumps(metadata.columns)
+        )
 
     def _update_registry(self, sequences_vtile) -> List[str]:
         new_sequence_ids = []
         for sequence in sequences_vtile["features"]:
             sequence_id = sequence["properties"]["id"]
-            if sequence_id in self._sequence_registry:
-                continue
-            self._sequence_registry.add(sequence_id)
-            new_sequence_ids.append(sequence_id)
+            if add_if_missing(self._sequence_registry, sequence_id):
+                new_sequence_ids.append(sequence_id)
         return new_sequence_ids
+
+
+def _write_file(path: Union[str, Path], data: bytes, mode: str) -> None:
+    with open(path, mode, buffering=1 << 20) as file:
+        file.write(data)
+
+
+def _get_metadata(image_data: Union[ImageMetadata, NamedPair]) -> ImageMetadata:
+    if isinstance(image_data, NamedPair):
+        return image_data.metadata
+    return image_data
+
+
+def _check_layer_zoom(layer: str, zoom: int) -> None:
+    if layer == TileType.IMAGE_LAYER and zoom != IMAGE_LAYER_ZOOM:
+        raise ValueError(
+            f"The `{TileType.IMAGE_LAYER}` layer is only served at zoom "
+            f"{IMAGE_LAYER_ZOOM}, got zoom {zoom}"
+        )
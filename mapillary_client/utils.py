@@ -1,4 +1,69 @@
+import asyncio
+import logging
+import random
+from contextlib import asynccontextmanager, nullcontext
+
+import aiohttp
+
+LOGGER = logging.getLogger()
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_RETRY_DELAY = 60
+
+
 def init_if_none(item, default=None):
     if item is None:
         return default
     return item
+
+
+def add_if_missing(registry, item):
+    size = len(registry)
+    registry.add(item)
+    return len(registry) != size
+
+
+@asynccontextmanager
+async def get_with_retry(session, url, *, semaphore=None, headers=None, max_tries=5):
+    semaphore = init_if_none(semaphore, nullcontext())
+    for attempt in range(1, max_tries + 1):
+        # The slot is only held while a request is in flight, not while backing off
+        async with semaphore:
+            try:
+                response = await session.get(url, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if attempt == max_tries:
+                    raise
+                reason = type(error).__name__
+                delay = _retry_delay(None, attempt)
+            else:
+                try:
+                    if response.status not in RETRY_STATUSES or attempt == max_tries:
+                        response.raise_for_status()
+                        yield response
+                        return
+                    reason = f"HTTP {response.status}"
+                    delay = _retry_delay(response, attempt)
+                finally:
+                    response.release()
+        LOGGER.warning(
+            "Got %s for %s, retry %d/%d in %.1fs",
+            reason,
+            url,
+            attempt,
+            max_tries - 1,
+            delay,
+        )
+        await asyncio.sleep(delay)
+
+
+def _retry_delay(response, attempt):
+    retry_after = None
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(MAX_RETRY_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    return min(MAX_RETRY_DELAY, 2**attempt + random.random())